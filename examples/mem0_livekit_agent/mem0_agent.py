@@ -1,8 +1,13 @@
+import asyncio
 import logging
 import os
-from typing import Optional
+import re
+from collections import deque
+from typing import Final, Optional
 
 from dotenv import load_dotenv
+import httpx
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 from livekit.agents import (
     Agent,
@@ -31,16 +36,129 @@ logger = logging.getLogger("basic-agent")
 
 load_dotenv()
 
-MEM0_API_KEY = os.getenv("MEM0_API_KEY")
-if not MEM0_API_KEY:
-    raise ValueError("MEM0_API_KEY is not set")
+# Greeting for users without any stored memories
+_FIRST_TIME_INSTR: Final[str] = "Greet the user and say: I'm glad we're talking for the first time! I'm excited to help you plan your dream trip."
 
-logger.info("Initializing Mem0 client...")
-mem0 = AsyncMemoryClient(api_key=MEM0_API_KEY)
+# Greeting used when memories are slow to load
+_GENERIC_GREETING_INSTR: Final[str] = "Greet the user warmly and ask how you can help plan their trip."
+
+# Greeting for returning users, and the follow-up used when the greeting went out before memories arrived
+_RETURNING_INSTR: Final[str] = "Greet {user_id} and say: {summary}"
+_FOLLOW_UP_INSTR: Final[str] = "Tell {user_id}: By the way, {summary}"
+
+# Opening of the greeting for returning users
+_SUMMARY_PREFIX: Final[str] = "I remember our previous conversation about your trip plans. "
+
+# Keywords that mark a memory as trip-related
+_TRIP_RE = re.compile(r"trip|travel|vacation|cruise|backpacking", re.IGNORECASE)
+
+# How long on_enter holds the greeting back waiting for memories
+_GREETING_WAIT = 0.6
+
+# How long on_enter waits for memories before giving up on them
+_MEM_LOAD_TIMEOUT = 3.0
+
+# Maximum number of messages sent in a single Mem0 add request
+_MEM_ADD_BATCH_SIZE = 100
+
+# How long store_important_info writes are held to be batched together
+_WRITE_BATCH_WINDOW = 0.2
+
+# Maximum number of memories written in one batch
+_WRITE_BATCH_MAX = 8
+
+# How long wipe_memories and flush_memories wait for queued writes to land
+_WRITE_DRAIN_TIMEOUT = 10.0
+
+# Maximum length of a single memory sent to Mem0
+_MAX_INFO_LENGTH = 2048
+
+# Maximum number of memories an agent keeps in process
+_MAX_MEMORIES = 256
+
+
+def _caused_by(exc: BaseException, types) -> bool:
+    # the Mem0 client re-raises httpx errors as its own exception types
+    return isinstance(exc, types) or isinstance(exc.__context__, types)
+
+
+def _is_transient(exc: BaseException) -> bool:
+    """Whether an idempotent Mem0 call failed on the network and is worth retrying."""
+    return _caused_by(exc, httpx.TransportError)
+
+
+def _is_unsent(exc: BaseException) -> bool:
+    """Whether a Mem0 call failed before its request was sent, so it is safe to retry a write."""
+    return _caused_by(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+async def with_retry(call, *args, retry_on=_is_transient, **kwargs):
+    """Await a Mem0 client call, retrying failures matched by retry_on with backoff.
+
+    The default retries any network failure, which is only safe for idempotent calls
+    like get_all and delete_all; writes pass retry_on=_is_unsent so a request that
+    may have reached Mem0 is never sent twice.
+    """
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(3),
+        # keep the jitter on the same scale as the base delay so retries stay
+        # within on_enter's memory load budget
+        wait=wait_exponential_jitter(multiplier=0.1, max=2, jitter=0.1),
+        retry=retry_if_exception(retry_on),
+        reraise=True,
+    ):
+        with attempt:
+            return await call(*args, **kwargs)
+
+
+def build_summary(latest_memory: Optional[str]) -> str:
+    """Build the returning-user greeting from their most recent trip memory."""
+    if latest_memory:
+        return f"{_SUMMARY_PREFIX}You were planning to {latest_memory.lower()}. Would you like to continue planning this trip?"
+    return _SUMMARY_PREFIX + "Let's continue planning your adventure!"
+
+
+async def load_memories(mem0: AsyncMemoryClient, user_id: str) -> list[str]:
+    """Return the stored memories for a user from Mem0."""
+    logger.info("Attempting to load memories for user: %s", user_id)
+
+    # Get all memories for the user using the correct format
+    memories = await with_retry(
+        mem0.get_all,
+        filters={
+            "AND": [
+                {
+                    "user_id": user_id
+                }
+            ]
+        },
+        version="v2"
+    )
+    logger.debug("Retrieved memories: %s", memories)
+    # Extract memory content from the correct field
+    result = [memory["memory"] for memory in memories if "memory" in memory] if memories else []
+    logger.info("Successfully loaded %s previous memories for user %s", len(result), user_id)
+    return result
 
 
 class MyAgent(Agent):
-    def __init__(self, username: Optional[str] = None) -> None:
+    __slots__ = (
+        "mem0",
+        "user_id",
+        "memories",
+        "_dirty",
+        "_write_queue",
+        "_batcher",
+        "_flush_lock",
+        "_mem_task",
+    )
+
+    def __init__(
+        self,
+        mem0: AsyncMemoryClient,
+        username: Optional[str] = None,
+        mem_task: Optional[asyncio.Task] = None,
+    ) -> None:
         super().__init__(
             instructions="""
             You are a helpful voice assistant named George, specializing in travel planning.
@@ -70,9 +188,19 @@ class MyAgent(Agent):
             - Keep responses concise and focused
             """,
         )
+        self.mem0 = mem0
         self.user_id = username or "default_user"
-        self.memories = []
-        logger.info(f"Initialized agent for user: {self.user_id}")
+        # most recent first, like Mem0; once full, the oldest memories drop off the end
+        self.memories: deque[str] = deque(maxlen=_MAX_MEMORIES)
+        # memories created this session that haven't reached Mem0 yet
+        self._dirty: set[str] = set()
+        # memories from store_important_info waiting to be written in a batch
+        self._write_queue: asyncio.Queue[str] = asyncio.Queue()
+        self._batcher: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        # memories prefetched by the entrypoint while the session starts up
+        self._mem_task = mem_task
+        logger.info("Initialized agent for user: %s", self.user_id)
 
 
     @function_tool
@@ -83,17 +211,21 @@ class MyAgent(Agent):
                 logger.error("No user_id available for wiping memories")
                 return "I had trouble clearing my memories - no user identified"
 
-            logger.info(f"Attempting to delete all memories for user: {self.user_id}")
+            logger.info("Attempting to delete all memories for user: %s", self.user_id)
+
+            # Let queued writes land first so they don't survive the wipe
+            await self._drain_writes()
             
             # Delete all memories for the user using the correct method
-            await mem0.delete_all(user_id=self.user_id)
+            await with_retry(self.mem0.delete_all, user_id=self.user_id)
             
-            self.memories = []
-            logger.info(f"Successfully wiped memories for user: {self.user_id}")
+            self.memories.clear()
+            self._dirty.clear()
+            logger.info("Successfully wiped memories for user: %s", self.user_id)
             return "I've cleared all my memories. We can start fresh!"
         except Exception as e:
-            logger.error(f"Error wiping memories for user {self.user_id}: {str(e)}")
-            logger.error(f"Full error details: {e.__dict__ if hasattr(e, '__dict__') else str(e)}")
+            logger.error("Error wiping memories for user %s: %s", self.user_id, e)
+            logger.debug("Full error details: %s", getattr(e, "__dict__", e))
             return "I had trouble clearing my memories. Please try again."
 
     @function_tool
@@ -106,109 +238,209 @@ class MyAgent(Agent):
             info: The important information to store
             category: The category of information (e.g., 'travel_planning', 'preferences', 'requirements')
         """
+        if not self.user_id:
+            logger.error("No user_id available for storing information")
+            return "I had trouble storing that information - no user identified"
+
+        # Bound the Mem0 payload and skip writes that would store nothing
+        info = (info or "").strip()[:_MAX_INFO_LENGTH]
+        if not info:
+            return "There was nothing to store"
+
+        # the deque is capped, so this scan stays bounded
+        if info in self.memories:
+            logger.debug("Skipping duplicate memory for user %s: %s", self.user_id, info)
+            return f"Already stored that information about {category}"
+
+        logger.info("Storing important information for user %s: %s", self.user_id, info)
+
+        self.memories.appendleft(info)
+
+        # Write to Mem0 in the background so the next turn isn't held up by the
+        # round trip, batching with any other memories stored around the same time
+        if self._batcher is None:
+            self._batcher = asyncio.create_task(self._batch_loop())
+        self._write_queue.put_nowait(info)
+        return f"Stored important information about {category}"
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._write_queue.get()]
+            try:
+                deadline = loop.time() + _WRITE_BATCH_WINDOW
+                while len(batch) < _WRITE_BATCH_MAX:
+                    try:
+                        batch.append(await asyncio.wait_for(self._write_queue.get(), deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        break
+                await self._persist(batch)
+            except asyncio.CancelledError:
+                # cancelled before the batch was written: keep it for the final flush
+                self._dirty.update(batch)
+                raise
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+
+    async def _drain_writes(self) -> None:
+        """Wait for queued writes to land, moving any still queued after the timeout to the dirty set."""
+        try:
+            await asyncio.wait_for(self._write_queue.join(), timeout=_WRITE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out waiting for queued memory writes for user %s", self.user_id)
+            while not self._write_queue.empty():
+                self._dirty.add(self._write_queue.get_nowait())
+                self._write_queue.task_done()
+
+    async def _persist(self, batch: list[str]) -> None:
         try:
-            if not self.user_id:
-                logger.error("No user_id available for storing information")
-                return "I had trouble storing that information - no user identified"
-
-            logger.info(f"Storing important information for user {self.user_id}: {info}")
-            
             # Format the memory data according to Mem0's API requirements
             messages = [
                 {
                     "role": "assistant",
                     "content": info
                 }
+                for info in batch
             ]
-            
-            logger.debug(f"Attempting to store memory with data: {messages}")
-            result = await mem0.add(
+
+            logger.debug("Attempting to store memory with data: %s", messages)
+            result = await with_retry(
+                self.mem0.add,
                 messages,
                 user_id=self.user_id,
-                version="v2"  # Specify version as per documentation
+                version="v2",  # Specify version as per documentation
+                retry_on=_is_unsent,
             )
-            logger.debug(f"Memory storage result: {result}")
-            
-            self.memories.append(info)
-            return f"Stored important information about {category}"
+            logger.debug("Memory storage result: %s", result)
         except Exception as e:
-            logger.error(f"Error storing important information for user {self.user_id}: {str(e)}")
-            logger.error(f"Full error details: {e.__dict__ if hasattr(e, '__dict__') else str(e)}")
-            return "I had trouble storing that information"
+            logger.error("Error storing important information for user %s: %s", self.user_id, e)
+            logger.debug("Full error details: %s", getattr(e, "__dict__", e))
+            # retry when the session ends
+            self._dirty.update(batch)
 
     async def on_enter(self):
         # Load previous memories when agent starts
+        greeted = False
         try:
             if not self.user_id:
                 logger.error("No user_id available for loading memories")
-                self.session.generate_reply(instructions="Greet the user and say: I'm glad we're talking for the first time! I'm excited to help you plan your dream trip.")
+                self.session.generate_reply(instructions=_FIRST_TIME_INSTR)
                 return
 
-            logger.info(f"Attempting to load memories for user: {self.user_id}")
-            
-            # Get all memories for the user using the correct format
-            memories = await mem0.get_all(
-                filters={
-                    "AND": [
-                        {
-                            "user_id": self.user_id
-                        }
-                    ]
-                },
-                version="v2"
-            )
-
+            if self._mem_task is None:
+                self._mem_task = asyncio.create_task(load_memories(self.mem0, self.user_id))
+
+            # Don't keep the user waiting in silence on a slow Mem0: greet now
+            # and follow up once the memories arrive
+            done, _ = await asyncio.wait({self._mem_task}, timeout=_GREETING_WAIT)
+            if not done:
+                logger.info("Memories not loaded yet, greeting user %s without them", self.user_id)
+                self.session.generate_reply(instructions=_GENERIC_GREETING_INSTR)
+                greeted = True
+
+            memories = await asyncio.wait_for(self._mem_task, timeout=_MEM_LOAD_TIMEOUT)
+            # Loaded memories are older than anything stored since the session
+            # started, so they go after those; keep the most recent ones that
+            # fit and pick out the trip-related ones in the same pass
+            trip_memories = []
+            stored = set(self.memories)
+            for memory in memories:
+                if len(self.memories) >= _MAX_MEMORIES:
+                    break
+                if memory in stored:
+                    continue
+                self.memories.append(memory)
+                if _TRIP_RE.search(memory):
+                    trip_memories.append(memory)
+
+            # only memories from Mem0 count as a previous conversation
             if memories:
-                logger.debug(f"Retrieved memories: {memories}")
-                # Extract memory content from the correct field
-                self.memories = [memory["memory"] for memory in memories if "memory" in memory]
-                logger.info(f"Successfully loaded {len(self.memories)} previous memories for user {self.user_id}")
-
-                if self.memories:
-                    # Create a detailed summary of previous trip plans
-                    summary = "I remember our previous conversation about your trip plans. "
-
-                    # Find the most recent trip-related memory
-                    trip_memories = [m for m in self.memories if any(word in m.lower() for word in ["trip", "travel", "vacation", "cruise", "backpacking"])]
-
-                    if trip_memories:
-                        # Get the most recent memory (assuming they're in chronological order)
-                        latest_memory = trip_memories[0]
-                        summary += f"You were planning to {latest_memory.lower()}. Would you like to continue planning this trip?"
-                    else:
-                        summary += "Let's continue planning your adventure!"
-
-                    self.session.generate_reply(instructions=f"Greet {self.user_id} and say: {summary}")
+                # Get the most recent trip memory (assuming they're in chronological order)
+                summary = build_summary(trip_memories[0] if trip_memories else None)
+
+                if greeted:
+                    self.session.generate_reply(instructions=_FOLLOW_UP_INSTR.format(user_id=self.user_id, summary=summary))
                 else:
-                    logger.info(f"No valid memories found for user {self.user_id}")
-                    self.session.generate_reply(instructions="Greet the user and say: I'm glad we're talking for the first time! I'm excited to help you plan your dream trip.")
-            else:
-                logger.info(f"No previous memories found for user {self.user_id}")
-                self.session.generate_reply(instructions="Greet the user and say: I'm glad we're talking for the first time! I'm excited to help you plan your dream trip.")
+                    self.session.generate_reply(instructions=_RETURNING_INSTR.format(user_id=self.user_id, summary=summary))
+            elif not greeted:
+                logger.info("No previous memories found for user %s", self.user_id)
+                self.session.generate_reply(instructions=_FIRST_TIME_INSTR)
         except Exception as e:
-            logger.error(f"Error loading memories for user {self.user_id}: {str(e)}")
-            logger.error(f"Full error details: {e.__dict__ if hasattr(e, '__dict__') else str(e)}")
-            self.memories = []  # Initialize empty memories list on error
-            self.session.generate_reply(instructions="Greet the user and say: I'm glad we're talking for the first time! I'm excited to help you plan your dream trip.")
+            logger.error("Error loading memories for user %s: %s", self.user_id, e)
+            logger.debug("Full error details: %s", getattr(e, "__dict__", e))
+            if not greeted:
+                self.session.generate_reply(instructions=_FIRST_TIME_INSTR)
 
 
     async def on_exit(self):
-        """Ensure all memories are stored when the session ends"""
-        try:
-            # Double check that all messages were stored
-            if self.memories:
-                logger.info(f"Final memory check - storing {len(self.memories)} memories")
-                for memory in self.memories:
-                    await mem0.add(
-                        [{"role": "assistant", "content": memory}],
-                        user_id=self.user_id
-                    )
-        except Exception as e:
-            logger.error(f"Error in final memory storage: {str(e)}")
+        """Ensure all new memories are stored when the session ends"""
+        await self.flush_memories()
+
+    async def flush_memories(self) -> None:
+        """Write out queued and previously failed memories.
+
+        Called from on_exit and again on job shutdown before the Mem0 client is
+        closed; the lock makes the second call wait for the first to finish.
+        """
+        async with self._flush_lock:
+            try:
+                await self._drain_writes()
+                if self._batcher is not None:
+                    # a batch still in flight goes back to the dirty set when cancelled
+                    self._batcher.cancel()
+                    await asyncio.wait({self._batcher})
+                    # a later store_important_info starts a fresh batcher
+                    self._batcher = None
+
+                # Store anything that failed to persist during the session
+                if self._dirty:
+                    pending = list(self._dirty)
+                    logger.info("Final memory check - storing %s memories", len(pending))
+                    # one request per batch instead of one per memory
+                    for i in range(0, len(pending), _MEM_ADD_BATCH_SIZE):
+                        chunk = pending[i:i + _MEM_ADD_BATCH_SIZE]
+                        await with_retry(
+                            self.mem0.add,
+                            [{"role": "assistant", "content": memory} for memory in chunk],
+                            user_id=self.user_id,
+                            version="v2",
+                            retry_on=_is_unsent,
+                        )
+                        # forget each chunk once written so a later flush doesn't resend it
+                        self._dirty.difference_update(chunk)
+            except Exception as e:
+                logger.error("Error in final memory storage: %s", e)
 
 def prewarm(proc: JobProcess):
+    # uvloop makes every await in the job cheaper; it isn't available on Windows
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     proc.userdata["vad"] = silero.VAD.load()
 
+    mem0_api_key = os.getenv("MEM0_API_KEY")
+    if not mem0_api_key:
+        raise ValueError("MEM0_API_KEY is not set")
+
+    logger.info("Initializing Mem0 client...")
+    # Share one pooled HTTP client so every Mem0 call reuses warm keep-alive connections;
+    # HTTP/2 lets concurrent calls (e.g. a background write during a load) share one connection
+    proc.userdata["mem0"] = AsyncMemoryClient(
+        api_key=mem0_api_key,
+        client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            # Mem0 add runs extraction server-side and can take a while, so keep the
+            # client's own generous read timeout; on_enter bounds the memory load itself
+            timeout=httpx.Timeout(300.0, connect=5.0),
+        ),
+    )
+
 async def entrypoint(ctx: JobContext):
     # each log entry will include these fields
     ctx.log_context_fields = {
@@ -219,7 +451,12 @@ async def entrypoint(ctx: JobContext):
 
     # Wait for participant
     participant = await ctx.wait_for_participant()
-    logger.info(f"Participant: {participant.identity}")
+    logger.info("Participant: %s", participant.identity)
+
+    mem0 = ctx.proc.userdata["mem0"]
+
+    # start fetching memories now so the round trip overlaps session startup
+    mem_task = asyncio.create_task(load_memories(mem0, participant.identity))
 
     session = AgentSession(
         vad=ctx.proc.userdata["vad"],
@@ -241,7 +478,7 @@ async def entrypoint(ctx: JobContext):
 
     async def log_usage():
         summary = usage_collector.get_summary()
-        logger.info(f"Usage: {summary}")
+        logger.info("Usage: %s", summary)
 
     # shutdown callbacks are triggered when the session is over
     ctx.add_shutdown_callback(log_usage)
@@ -250,7 +487,7 @@ async def entrypoint(ctx: JobContext):
     await ctx.wait_for_participant()
 
     # TODO: base agent memory on SIP phone number if this is a SIP call
-    agent = MyAgent(username=participant.identity)
+    agent = MyAgent(mem0=mem0, username=participant.identity, mem_task=mem_task)
     await session.start(
         agent=agent,
         room=ctx.room,
@@ -258,6 +495,13 @@ async def entrypoint(ctx: JobContext):
         room_output_options=RoomOutputOptions(transcription_enabled=True),
     )
 
+    async def close_mem0():
+        # the agent's final writes need the client, so close it only after they're done
+        await agent.flush_memories()
+        await mem0.async_client.aclose()
+
+    ctx.add_shutdown_callback(close_mem0)
+
     background_audio = BackgroundAudioPlayer(
         # play keyboard typing sound when the agent is thinking
         thinking_sound=[
@@ -269,7 +513,7 @@ async def entrypoint(ctx: JobContext):
     try:
         await background_audio.start(room=ctx.room, agent_session=session)
     except Exception as e:
-        logger.error(f"Error starting background audio: {e}")
+        logger.error("Error starting background audio: %s", e)
         # Continue without background audio if it fails
         background_audio = None
 
@@ -278,4 +522,8 @@ async def entrypoint(ctx: JobContext):
 
 
 if __name__ == "__main__":
+    # fail before registering with LiveKit rather than in every job process's prewarm
+    if not os.getenv("MEM0_API_KEY"):
+        raise ValueError("MEM0_API_KEY is not set")
+
     cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))
\ No newline at end of file